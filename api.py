@@ -3,30 +3,78 @@
 """
 hpc restful api
 """
+import asyncio
+import base64
 import secrets
 import logging
 import json
+import time
+import threading
+from collections import Counter
 from enum import Enum
-from typing import Union, List
+from functools import lru_cache
+from typing import Union, List, Tuple, Optional
 
 import jmespath
 import toml
 import redis.asyncio as redis
-from fastapi import FastAPI, Depends, HTTPException, status, Query
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import JSONResponse
+from anyio import to_thread
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request
+from fastapi.security import HTTPBasic
+from fastapi.responses import ORJSONResponse, Response
+from starlette.concurrency import run_in_threadpool
 from python_freeipa import ClientMeta
+from python_freeipa.exceptions import Unauthorized
 
 with open('/etc/pbs_cache.toml') as f:
     config = toml.load(f)
-app = FastAPI()
-security = HTTPBasic()
+app = FastAPI(default_response_class=ORJSONResponse)
 location = config['location']
 redis_conf = config['redis'][location]
 logger = logging.getLogger()
 ipa = ClientMeta(config['ipa']['host'], verify_ssl=False)
+ipa_lock = threading.Lock()
+ipa_expire = 0.0
 conn = redis.Redis(**redis_conf, auto_close_connection_pool=False)
-replacement = [('.', '_'), ('[', '_'), (']', '')]
+j = conn.json()
+conn_raw = redis.Redis(**{**redis_conf, 'decode_responses': False}, auto_close_connection_pool=False)
+member_user_expr = jmespath.compile('result.member_user')
+group_name_expr = jmespath.compile('result[0].cn[0]')
+replacement = str.maketrans({'.': '_', '[': '_', ']': None})
+
+
+class TTLCache:
+    """
+    in-process cache for serialized redis query results, expired after ttl seconds
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 4096):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data = {}
+        self.stats = Counter()
+
+    def get(self, key: tuple) -> Optional[Response]:
+        endpoint = key[0]
+        item = self.data.get(key)
+        if item and item[0] > time.monotonic():
+            self.stats[f'{endpoint}_hit'] += 1
+            return Response(content=item[1], media_type='application/json')
+        self.stats[f'{endpoint}_miss'] += 1
+        return None
+
+    def set(self, key: tuple, value: dict) -> Response:
+        return self.set_body(key, ORJSONResponse(value).body)
+
+    def set_body(self, key: tuple, body: bytes) -> Response:
+        self.data.pop(key, None)
+        while len(self.data) >= self.maxsize:
+            self.data.pop(next(iter(self.data)))
+        self.data[key] = (time.monotonic() + self.ttl, body)
+        return Response(content=body, media_type='application/json')
+
+
+cache = TTLCache(config['api'].get('cache_ttl', 30))
 
 
 class Subject(Enum):
@@ -36,30 +84,95 @@ class Subject(Enum):
     nodes = 'nodes'
 
 
-Site = Enum('Site', {k['location']: k['location'] for k in config['site']})
+site_names = {k['location']: k['name'] for k in config['site']}
+Site = Enum('Site', {k: k for k in site_names})
 
 
 def trans_key(key: str) -> str:
-    for a, b in replacement:
-        key = key.replace(a, b)
-    return key
+    return key.translate(replacement)
+
+
+def to_str(value: Union[bytes, str]) -> str:
+    return value.decode() if isinstance(value, bytes) else value
 
 
-def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
-    correct_username = secrets.compare_digest(credentials.username, config['api']['user'])
-    correct_password = secrets.compare_digest(credentials.password, config['api']['password'])
-    if not (correct_username and correct_password):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect email or password",
-            headers={"WWW-Authenticate": "Basic"},
-        )
-    return credentials.username
+@lru_cache(maxsize=256)
+def build_path(subject: Subject, wildcard: bool, item: Tuple[str, ...]) -> Tuple[str, str]:
+    """
+    json path of detail data, split into the parts before and after the name
+    """
+    root = '$' if wildcard or item else ''
+    suffix = f'.{json.dumps(list(item))}' if item else ''
+    return f'{root}.{subject.name}.', suffix
+
+
+def ipa_call(method: str, *args, **kwargs):
+    """
+    call ipa api with the cached login session, login again when it is about to expire
+    """
+    global ipa_expire
+    for retry in (True, False):
+        with ipa_lock:
+            if time.monotonic() > ipa_expire - 60:
+                ipa.login(config['ipa']['user'], config['ipa']['password'])
+                ipa_expire = time.monotonic() + config['ipa'].get('session_ttl', 1200)
+        try:
+            return getattr(ipa, method)(*args, **kwargs)
+        except Unauthorized:
+            if not retry:
+                raise
+            ipa_expire = 0.0
+
+
+@lru_cache(maxsize=1024)
+def check_authorization(authorization: str) -> Optional[str]:
+    """
+    verify http basic authorization header, return the username if it is correct
+    """
+    scheme, _, param = authorization.partition(' ')
+    if scheme.lower() != 'basic':
+        return None
+    try:
+        username, _, password = base64.b64decode(param).decode('ascii').partition(':')
+    except ValueError:
+        return None
+    correct_username = secrets.compare_digest(username, config['api']['user'])
+    correct_password = secrets.compare_digest(password, config['api']['password'])
+    return username if correct_username and correct_password else None
+
+
+class CachedHTTPBasic(HTTPBasic):
+    """
+    http basic auth, the check result is cached by authorization header
+    """
+
+    async def __call__(self, request: Request) -> str:
+        username = check_authorization(request.headers.get('Authorization', ''))
+        if username is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect email or password",
+                headers={"WWW-Authenticate": "Basic"},
+            )
+        return username
+
+
+security = CachedHTTPBasic()
+
+
+def get_current_username(username: str = Depends(security)):
+    return username
+
+
+@app.on_event('startup')
+async def startup():
+    to_thread.current_default_thread_limiter().total_tokens = config['api'].get('threads', 64)
 
 
 @app.on_event('shutdown')
 async def shutdown():
     await conn.close()
+    await conn_raw.close()
 
 
 @app.get('/pbs')
@@ -75,13 +188,16 @@ async def get_site_info(site: Site, cred=Depends(get_current_username)):
     """
     get all data of site
     """
-    result = {'result': True}
     site = site.name
+    cache_key = ('site_info', site)
+    if cached := cache.get(cache_key):
+        return cached
+    result = {'result': True}
     try:
-        j = conn.json()
         timestamp = await j.get(f'pbs_{site}', '.timestamp')
         result['timestamp'] = int(timestamp)
-        result['name'] = [s['name'] for s in config['site'] if s['location'] == site][0]
+        result['name'] = site_names[site]
+        return cache.set(cache_key, result)
     except Exception as e:
         result['result'] = False
         result['msg'] = f'backend failure, {str(e)}'
@@ -93,23 +209,33 @@ async def get_list(site: Site, subject: Subject, cred=Depends(get_current_userna
     """
     get all data for the specified subject
     """
-    result = {'result': True}
     site = site.name
+    cache_key = ('list', site, subject.name)
+    if cached := cache.get(cache_key):
+        return cached
+    result = {'result': True}
     try:
-        j = conn.json()
-        data = await j.get(f'pbs_{site}', f'.{subject.name}')
-        keys = list(data.keys())
         if subject is Subject.Jobs:
+            keys, exists = await asyncio.gather(conn.smembers(f'pbs_{site}:jobs'), conn.exists(f'pbs_{site}'))
+            if not exists:
+                raise LookupError(f'no data of site {site}')
             result['count'] = len(keys)
-            result['data'] = [s.replace('_', '.', 1) for s in keys]
+            result['data'] = [to_str(s).replace('_', '.', 1) for s in keys]
         elif subject is Subject.nodes:
-            result['count'] = len(keys)
-            result['data'] = list({s.split('_')[0] for s in keys})
+            hosts, count = await asyncio.gather(conn.smembers(f'pbs_{site}:nodes'),
+                                                j.objlen(f'pbs_{site}', '.nodes'))
+            if count is None:
+                raise LookupError(f'no data of site {site}')
+            result['count'] = count
+            result['data'] = [to_str(s) for s in hosts]
         elif subject is Subject.Queue:
+            keys = await j.objkeys(f'pbs_{site}', '.Queue')
             result['count'] = len(keys)
-            result['data'] = keys
+            result['data'] = [to_str(s) for s in keys]
         else:
+            data = await j.get(f'pbs_{site}', f'.{subject.name}')
             result['data'] = list(data.values())[0]
+        return cache.set(cache_key, result)
     except Exception as e:
         result = {'result': False, 'msg': f'backend failure, {str(e)}'}
     return result
@@ -121,71 +247,79 @@ async def get_data(site: Site, subject: Subject, name: str, item: Union[List[str
     """
     get detail data
     """
-    result = {'result': True}
     site = site.name
     name = trans_key(name)
+    cache_key = ('data', site, subject.name, name, tuple(item or ()))
+    if cached := cache.get(cache_key):
+        return cached
     try:
-        j = conn.json()
-        root = '$' if name == '*' or item else ''
+        prefix, suffix = build_path(subject, name == '*', tuple(item or ()))
         if subject is Subject.nodes:
-            search_str = f'$.nodes.*[?(@.Mom=="{name}")]'
+            if node_keys := await conn.hget(f'pbs_{site}:mom_index', name):
+                search_str = f'$.nodes.{to_str(node_keys)}{suffix}'
+            else:
+                search_str = f'$.nodes.*[?(@.Mom=="{name}")]{suffix}'
         else:
-            search_str = f'{root}.{subject.name}.{name}'
-        if item:
-            search_str += f'.{json.dumps(item)}'
+            search_str = f'{prefix}{name}{suffix}'
 
-        logger.debug(f'searching expression:{search_str}')
-        data = await j.get(f'pbs_{site}', search_str)
-        result['data'] = data
+        logger.debug('searching expression:%s', search_str)
+        raw = await conn_raw.execute_command('JSON.GET', f'pbs_{site}', search_str)
+        return cache.set_body(cache_key, b'{"result":true,"data":' + (raw or b'null') + b'}')
     except Exception as e:
         result = {'result': False, 'msg': f'backend failure, {str(e)}'}
     return result
 
 
+@app.get('/cache')
+async def get_cache_stats(cred=Depends(get_current_username)):
+    """
+    get hit/miss count of the query cache
+    """
+    return {'result': True, 'ttl': cache.ttl, 'size': len(cache.data), 'data': cache.stats}
+
+
 @app.get('/user')
-def get_user_list(group: str = 'hpc', cred=Depends(get_current_username)):
+async def get_user_list(group: str = 'hpc', cred=Depends(get_current_username)):
     """
     get user list
     """
     result = {'result': True}
     try:
-        ipa.login(config['ipa']['user'], config['ipa']['password'])
-        user_info = ipa.group_show(group)
-        result['data'] = jmespath.search('result.member_user', user_info)
+        user_info = await run_in_threadpool(ipa_call, 'group_show', group)
+        result['data'] = member_user_expr.search(user_info)
     except Exception as e:
         result['result'] = False
         result['msg'] = f'{str(e)}'
-        return JSONResponse(status_code=404, content=result)
+        return ORJSONResponse(status_code=404, content=result)
     return result
 
 
 @app.get('/user/{username}')
-def get_user_info(username: str, cred=Depends(get_current_username)):
+async def get_user_info(username: str, cred=Depends(get_current_username)):
     """
     get user data
     """
     result = {'result': True}
     data = {}
     try:
-        ipa.login(config['ipa']['user'], config['ipa']['password'])
-        user_data = ipa.user_show(username)['result']
+        user_data = (await run_in_threadpool(ipa_call, 'user_show', username))['result']
         group = user_data.get('memberof_group', []) + user_data.get('memberofindirect_group', [])
         if 'hpc' not in group:
             result['result'] = False
             result['msg'] = 'invalid user'
-            return JSONResponse(status_code=404, content=result)
+            return ORJSONResponse(status_code=404, content=result)
         data['group'] = group
         gid = user_data['gidnumber'][0]
         if user_data['uidnumber'][0] == gid:
             data['main_group'] = None
         else:
-            group_info = ipa.group_find(o_gidnumber=gid)
-            data['main_group'] = jmespath.search('result[0].cn[0]', group_info) or None
+            group_info = await run_in_threadpool(ipa_call, 'group_find', o_gidnumber=gid)
+            data['main_group'] = group_name_expr.search(group_info) or None
         result['data'] = data
     except Exception as e:
         result['result'] = False
         result['msg'] = f'{str(e)}'
-        return JSONResponse(status_code=404, content=result)
+        return ORJSONResponse(status_code=404, content=result)
     return result
 
 
@@ -194,15 +328,12 @@ async def get_user_jobs(username: str, cred=Depends(get_current_username)):
     result = {'result': True}
     data = {}
     try:
-        j = conn.json()
+        async with conn.pipeline(transaction=False) as pipe:
+            for site in site_names:
+                pipe.smembers(f'pbs_{site}:user:{username}')
+            job_lists = await pipe.execute()
     except Exception as e:
         return {'result': False, 'msg': f'backend failure, {str(e)}'}
-    jobs = []
-    for site_dict in config['site']:
-        site = site_dict['location']
-        job_search = f'$.Jobs.*[?(@.euser=="{username}")].id'
-        job_list = await j.get(f'pbs_{site}', job_search)
-        jobs.extend(job_list)
-        data['jobs'] = jobs
+    data['jobs'] = [to_str(job) for job_list in job_lists for job in job_list]
     result['data'] = data
     return result
@@ -4,14 +4,17 @@
 save pbs data into redis cache
 """
 from argparse import ArgumentParser
-from collections import Counter
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple
 import subprocess
 import json
 import re
 import logging
+import hashlib
 import statistics
+import time
 
+import orjson
 import redis
 import toml
 import jmespath
@@ -20,12 +23,38 @@ parser = ArgumentParser(description=__doc__)
 parser.add_argument('-c', '--config', default='/etc/pbs_cache.toml', help='config file')
 parser.add_argument('-l', '--log_level', choices=['debug', 'info', 'error'], default='info', help='debug level')
 parser.add_argument('-t', '--test', action='store_true', help='test mode')
-replacement = [('.', '_'), ('[', '_'), (']', '')]
+parser.add_argument('-i', '--interval', type=int, default=0,
+                    help='keep running and sync every INTERVAL seconds, sync once if 0')
+replacement = str.maketrans({'.': '_', '[': '_', ']': None})
+pbs_commands = (('/opt/pbs/bin/qstat', '-Bf', '-F', 'json'),
+                ('/opt/pbs/bin/qstat', '-Qf', '-F', 'json'),
+                ('/opt/pbs/bin/pbsnodes', '-avj', '-F', 'json'),
+                ('/opt/pbs/bin/qstat', '-f', '-F', 'json'))
+resource_list_exprs = {res: jmespath.compile(f'resources_available."{res}"') for res in ('App', 'Team')}
+queue_config_expr = jmespath.compile(
+    'resources_available.{host: ncpu_perhost, vnode: ncpu_pernode, socket: ncpu_pernuma, gpus_vnode: ngpu_pernode}')
+pool_options = {'socket_timeout': 5,
+                'socket_connect_timeout': 2,
+                'socket_keepalive': True,
+                'health_check_interval': 30,
+                'max_connections': 4}
+dev_types = ('ibswitch', 'host', 'socket', 'vnode')
+job_metrics = ('using_cores', 'running_jobs', 'using_gpus', 'waiting_cores', 'waiting_jobs', 'waiting_gpus')
 batch_state_pat = re.compile(
     r'Queued:(?P<Queued>\d+) Running:(?P<Running>\d+) Exiting:(?P<Exiting>\d+) Expired:(?P<Expired>\d+)')
 
 
-def safety_loads(data: str, max_retries=5) -> dict:
+def pbs_output(*args: str) -> bytes:
+    """
+    run pbs command and read its output as bytes
+    """
+    p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.stderr:
+        logging.warning('%s: %s', ' '.join(args), p.stderr.decode(errors='replace').strip())
+    return p.stdout
+
+
+def safety_loads(data: bytes, max_retries=5) -> dict:
     """
     fix pbs error
     """
@@ -34,23 +63,26 @@ def safety_loads(data: str, max_retries=5) -> dict:
             logging.error("empty pbs data")
             return {}
         try:
-            d = json.loads(data)
+            d = orjson.loads(data)
             return d
-        except json.decoder.JSONDecodeError as e:
-            l = data.split('\n')
-            l.pop(e.lineno - 1)
-            data = '\n'.join(l)
+        except orjson.JSONDecodeError as e:
+            if not isinstance(data, bytearray):
+                data = bytearray(data)
+            start = 0
+            for _ in range(e.lineno - 1):
+                start = data.index(b'\n', start) + 1
+            end = data.find(b'\n', start)
+            del data[start:len(data) if end == -1 else end + 1]
             max_retries -= 1
 
 
 def trans_key(key: str) -> str:
-    for a, b in replacement:
-        key = key.replace(a, b)
-    return key
+    return key.translate(replacement)
 
 
 def get_resource_list(res: str, data: dict) -> list:
-    raw = jmespath.search(f'resources_available."{res}"', data)
+    expr = resource_list_exprs.get(res) or jmespath.compile(f'resources_available."{res}"')
+    raw = expr.search(data)
     return raw.split(',') if raw else []
 
 
@@ -58,6 +90,7 @@ class DevNode:
     """
     ibswitch, host, socket, vnode
     """
+    __slots__ = ('type', 'name', 'full_cores', 'full_gpus', 'unused_cores', 'unused_gpus', 'children')
 
     def __init__(self, dev_type, name, full_cores=None, full_gpus=None):
         self.type = dev_type
@@ -71,39 +104,55 @@ class DevNode:
     def add_child(self, node):
         self.children[node.name] = node
 
-    def has_child(self, name) -> bool:
-        return name in self.children
-
-    def free_cores_group(self, gpu=False) -> List[int]:
-        if self.type == 'vnode':
-            return [self.unused_gpus if gpu else self.unused_cores]
-        else:
-            cores = [0]
-            for c in self.children.values():
-                c_free = c.free_cores_group(gpu)
-                full_cores = c.full_gpus if gpu else c.full_cores
-                if full_cores and sum(c_free) == full_cores and self.type != 'cluster':
-                    cores[0] += full_cores
-                else:
-                    cores.extend(c_free)
-            return sorted([c for c in cores if c != 0], reverse=True)
+    def free_groups(self) -> Tuple[List[int], List[int]]:
+        """
+        free cores and free gpus of the subtree, a fully free device counts as one group
+        """
+        results = {}
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if node.type == 'vnode':
+                results[id(node)] = ([node.unused_cores], [node.unused_gpus])
+            elif not visited:
+                stack.append((node, True))
+                stack.extend((c, False) for c in node.children.values())
+            else:
+                cores, gpus = [0], [0]
+                for c in node.children.values():
+                    c_cores, c_gpus = results.pop(id(c))
+                    for group, c_free, full in ((cores, c_cores, c.full_cores), (gpus, c_gpus, c.full_gpus)):
+                        if full and sum(c_free) == full and node.type != 'cluster':
+                            group[0] += full
+                        else:
+                            group.extend(c_free)
+                results[id(node)] = (sorted([c for c in cores if c != 0], reverse=True),
+                                     sorted([g for g in gpus if g != 0], reverse=True))
+        return results[id(self)]
 
 
 class BaseStat:
+    __slots__ = ('users', 'job_size', 'counter')
+
     def __init__(self):
         self.users = set()
         self.job_size = []
-        self.counter = Counter(waiting_cores=0,
-                               offline_cores=0,
-                               free_cores=0,
-                               using_cores=0,
-                               running_jobs=0,
-                               waiting_jobs=0,
-                               free_gpus=0,
-                               using_gpus=0,
-                               waiting_gpus=0,
-                               offline_gpus=0
-                               )
+        self.counter = {'waiting_cores': 0,
+                        'offline_cores': 0,
+                        'free_cores': 0,
+                        'using_cores': 0,
+                        'running_jobs': 0,
+                        'waiting_jobs': 0,
+                        'free_gpus': 0,
+                        'using_gpus': 0,
+                        'waiting_gpus': 0,
+                        'offline_gpus': 0
+                        }
+
+    def count(self, **kwargs):
+        counter = self.counter
+        for k, v in kwargs.items():
+            counter[k] += v
 
     @property
     def load(self) -> float:
@@ -135,31 +184,35 @@ class ServerInfo(BaseStat):
     """
     pbs server info
     """
+    __slots__ = ()
 
     def __init__(self):
         super(ServerInfo, self).__init__()
-        self.counter.update(total_cores=0)
-        self.counter.update(total_gpus=0)
+        self.counter['total_cores'] = 0
+        self.counter['total_gpus'] = 0
 
     def add_vnode(self, all_cores: int, assigned_cores: int, all_gpus: int, assigned_gpus: int, is_offline: bool):
-        self.counter.update(total_cores=all_cores, total_gpus=all_gpus)
+        c = self.counter
+        c['total_cores'] += all_cores
+        c['total_gpus'] += all_gpus
         if is_offline:
-            self.counter.update(offline_cores=all_cores, offline_gpus=all_gpus)
-        free_cores = all_cores - assigned_cores
-        free_gpus = all_gpus - assigned_gpus
-        self.counter.update(free_cores=free_cores, free_gpus=free_gpus)
+            c['offline_cores'] += all_cores
+            c['offline_gpus'] += all_gpus
+        c['free_cores'] += all_cores - assigned_cores
+        c['free_gpus'] += all_gpus - assigned_gpus
 
 
 class QueueInfo(BaseStat):
     """
     pbs queue info
     """
+    __slots__ = ('root', 'name', 'full_cores_map', 'full_gpus_map')
 
     def __init__(self, queue: str, host: int, socket: int, vnode: int, gpus_vnode: int):
         super(QueueInfo, self).__init__()
         self.root = DevNode('cluster', 'root')
         self.name = queue
-        self.counter.update(min_cores=0, max_cores=0, min_gpus=0, max_gpus=0)
+        self.counter.update({'min_cores': 0, 'max_cores': 0, 'min_gpus': 0, 'max_gpus': 0})
         self.full_cores_map = {
             "host": host,
             "socket": socket,
@@ -171,28 +224,34 @@ class QueueInfo(BaseStat):
                               }
 
     def add_vnode(self, all_cores: int, assigned_cores: int, all_gpus: int, assigned_gpus: int, is_offline: bool,
-                  is_private: bool, **devices):
+                  is_private: bool, devices: tuple):
+        c = self.counter
         if is_offline:
-            self.counter.update(offline_cores=all_cores, offline_gpus=all_gpus)
-            self.counter.update(max_cores=assigned_cores, max_gpus=assigned_gpus)
+            c['offline_cores'] += all_cores
+            c['offline_gpus'] += all_gpus
+            c['max_cores'] += assigned_cores
+            c['max_gpus'] += assigned_gpus
             if is_private:
-                self.counter.update(min_cores=assigned_cores, min_gpus=assigned_gpus)
+                c['min_cores'] += assigned_cores
+                c['min_gpus'] += assigned_gpus
             return
-        self.counter.update(max_cores=all_cores, max_gpus=all_gpus)
+        c['max_cores'] += all_cores
+        c['max_gpus'] += all_gpus
         if is_private:
-            self.counter.update(min_cores=all_cores, min_gpus=all_gpus)
+            c['min_cores'] += all_cores
+            c['min_gpus'] += all_gpus
         free_cores = all_cores - assigned_cores
         free_gpus = all_gpus - assigned_gpus
-        self.counter.update(free_cores=free_cores, free_gpus=free_gpus)
+        c['free_cores'] += free_cores
+        c['free_gpus'] += free_gpus
         if free_cores == 0:
             return
         cur_node = self.root
-        for dev_type in ("ibswitch", "host", "socket", "vnode"):
-            dev_name = devices.get(dev_type)
+        for dev_type, dev_name in zip(dev_types, devices):
             if not dev_name:
                 continue
-            if cur_node.has_child(dev_name):
-                cur_node = cur_node.children[dev_name]
+            if child := cur_node.children.get(dev_name):
+                cur_node = child
             else:
                 node = DevNode(dev_type, dev_name, full_cores=self.full_cores_map.get(dev_type, 0),
                                full_gpus=self.full_gpus_map.get(dev_type, 0))
@@ -208,8 +267,7 @@ class QueueInfo(BaseStat):
         """
         result = super(QueueInfo, self).export()
         result['queue'] = self.name
-        result['free_cores_group'] = self.root.free_cores_group()
-        result['free_gpus_group'] = self.root.free_cores_group(gpu=True)
+        result['free_cores_group'], result['free_gpus_group'] = self.root.free_groups()
         return result
 
 
@@ -218,18 +276,15 @@ def pbs_data_ex() -> dict:
     parse and update pbs data
     """
     logging.debug('getting data from pbs')
-    pbs_server = safety_loads(subprocess.getoutput(f'/opt/pbs/bin/qstat -Bf -F json'))
-    pbs_queues = safety_loads(subprocess.getoutput(f'/opt/pbs/bin/qstat -Qf -F json'))
-    pbs_nodes = safety_loads(subprocess.getoutput(f'/opt/pbs/bin/pbsnodes -avj -F json'))
-    pbs_jobs = safety_loads(subprocess.getoutput(f'/opt/pbs/bin/qstat -f -F json'))
+    with ThreadPoolExecutor(len(pbs_commands)) as executor:
+        outputs = executor.map(lambda cmd: pbs_output(*cmd), pbs_commands)
+        pbs_server, pbs_queues, pbs_nodes, pbs_jobs = [safety_loads(output) for output in outputs]
     logging.debug('parsing pbs data')
     server_info = ServerInfo()
     extra_queue_data = {}
     # queue init
     for q, queue_data in pbs_queues["Queue"].items():
-        if not (raw := jmespath.search(
-                'resources_available.{host: ncpu_perhost, vnode: ncpu_pernode, socket: ncpu_pernuma, gpus_vnode: ngpu_pernode}',
-                queue_data)):
+        if not (raw := queue_config_expr.search(queue_data)):
             continue
         queue_config = {k: v or 0 for k, v in raw.items()}
         queue_data['name'] = q
@@ -237,59 +292,60 @@ def pbs_data_ex() -> dict:
         queue_data['teams'] = get_resource_list('Team', queue_data)
         extra_queue_data[q] = QueueInfo(q, **queue_config)
     # add node info to queue
-    for vnode, node_data in pbs_nodes.get("nodes", {}).copy().items():
+    for vnode, node_data in pbs_nodes.get("nodes", {}).items():
+        available = node_data.get('resources_available') or {}
         if q := node_data.get('queue'):
             queues = [q]
-        elif q := jmespath.search("resources_available.Qlist", node_data):
+        elif q := available.get('Qlist'):
             queues = q.split(',')
         else:
             continue
         is_private = len(queues) == 1
-        all_cores = jmespath.search('resources_available.ncpus', node_data)
-        assigned_cores = jmespath.search('resources_assigned.ncpus', node_data) or 0
-        all_gpus = jmespath.search('resources_available.ngpus', node_data) or 0
-        assigned_gpus = jmespath.search('resources_assigned.ngpus', node_data) or 0
-        devices = jmespath.search('resources_available.{ibswitch: ibswitch, host: host, socket: numa, vnode: vnode}',
-                                  node_data)
+        assigned = node_data.get('resources_assigned') or {}
+        all_cores = available.get('ncpus') or 0
+        assigned_cores = assigned.get('ncpus') or 0
+        all_gpus = available.get('ngpus') or 0
+        assigned_gpus = assigned.get('ngpus') or 0
+        devices = (available.get('ibswitch'), available.get('host'), available.get('numa'), available.get('vnode'))
         node_stat = node_data.get('state', '').split(',')
         is_offline = bool(set(node_stat) & {'down', 'offline', 'Stale'})
         server_info.add_vnode(all_cores, assigned_cores, all_gpus, assigned_gpus, is_offline)
         for q in queues:
             if queue := extra_queue_data.get(q):
-                queue.add_vnode(all_cores, assigned_cores, all_gpus, assigned_gpus, is_offline, is_private, **devices)
-        pbs_nodes['nodes'][trans_key(vnode)] = pbs_nodes['nodes'].pop(vnode)
+                queue.add_vnode(all_cores, assigned_cores, all_gpus, assigned_gpus, is_offline, is_private, devices)
+    if 'nodes' in pbs_nodes:
+        pbs_nodes['nodes'] = {trans_key(k): v for k, v in pbs_nodes['nodes'].items()}
     # add job info to queue
-    for job, job_data in pbs_jobs.get('Jobs', {}).copy().items():
+    job_stats = {q: dict.fromkeys(job_metrics, 0) for q in extra_queue_data}
+    for job, job_data in pbs_jobs.get('Jobs', {}).items():
         job_data['id'] = job
         q = job_data["queue"]
         if q not in extra_queue_data:
             logging.error(f'queue {q} is not well configured')
             continue
         queue = extra_queue_data[q]
+        stats = job_stats[q]
         state = job_data['job_state']
-        cores, gpus = [n or 0 for n in jmespath.search('Resource_List.[ncpus, ngpus]', job_data)]
-        user = job_data['euser']
-        queue.users.add(user)
-        server_info.users.add(user)
-        jobsize = jmespath.search('Resource_List.ncpus', job_data) or 0
-        queue.job_size.append(jobsize)
-        server_info.job_size.append(jobsize)
+        resource_list = job_data.get('Resource_List') or {}
+        cores = resource_list.get('ncpus') or 0
+        gpus = resource_list.get('ngpus') or 0
+        queue.users.add(job_data['euser'])
+        queue.job_size.append(cores)
         if state == 'R':
-            server_info.counter.update(using_cores=cores, running_jobs=1, using_gpus=gpus)
-            queue.counter.update(using_cores=cores, running_jobs=1, using_gpus=gpus)
+            stats['using_cores'] += cores
+            stats['running_jobs'] += 1
+            stats['using_gpus'] += gpus
         elif state == 'B':
             try:
                 array_state_count = batch_state_pat.match(job_data.get('array_state_count')).groupdict()
                 running_count = int(array_state_count['Running'])
                 queued_count = int(array_state_count['Queued'])
-                count_dict = {'using_cores': running_count * cores,
-                              'running_jobs': running_count,
-                              'using_gpus': running_count * gpus,
-                              'waiting_cores': queued_count * cores,
-                              'waiting_jobs': queued_count,
-                              'waiting_gpus': queued_count * gpus}
-                server_info.counter.update(**count_dict)
-                queue.counter.update(**count_dict)
+                stats['using_cores'] += running_count * cores
+                stats['running_jobs'] += running_count
+                stats['using_gpus'] += running_count * gpus
+                stats['waiting_cores'] += queued_count * cores
+                stats['waiting_jobs'] += queued_count
+                stats['waiting_gpus'] += queued_count * gpus
             except Exception as e:
                 logging.error(f'batch job error, id {job}, error: {str(e)}')
         elif state == 'Q':
@@ -300,22 +356,121 @@ def pbs_data_ex() -> dict:
                 waiting_gpus = gpus * waiting_jobs
             else:
                 waiting_jobs, waiting_cores, waiting_gpus = 1, cores, cores
-            server_info.counter.update(waiting_cores=waiting_cores, waiting_jobs=waiting_jobs, waiting_gpus=waiting_gpus)
-            queue.counter.update(waiting_cores=waiting_cores, waiting_jobs=waiting_jobs, waiting_gpus=waiting_gpus)
-        pbs_jobs['Jobs'].pop(job)
-        pbs_jobs['Jobs'][trans_key(job)] = job_data
+            stats['waiting_cores'] += waiting_cores
+            stats['waiting_jobs'] += waiting_jobs
+            stats['waiting_gpus'] += waiting_gpus
+    if 'Jobs' in pbs_jobs:
+        pbs_jobs['Jobs'] = {trans_key(k): v for k, v in pbs_jobs['Jobs'].items()}
+    for q, stats in job_stats.items():
+        queue = extra_queue_data[q]
+        queue.count(**stats)
+        server_info.count(**stats)
+        server_info.users.update(queue.users)
+        server_info.job_size.extend(queue.job_size)
     # update server data
     for d in pbs_server['Server'].values():
         d['statistics'] = server_info.export()
     # update queue data
     for q, queue_info in extra_queue_data.items():
         adv_data = queue_info.export()
-        logging.debug(f'queue {q} statistics:')
-        logging.debug(json.dumps(adv_data, indent=True))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('queue %s statistics:\n%s', q, json.dumps(adv_data, indent=True))
         pbs_queues['Queue'][q]['statistics'] = adv_data
     return {**pbs_server, **pbs_queues, **pbs_nodes, **pbs_jobs}
 
 
+def build_indices(data: dict) -> dict:
+    """
+    auxiliary keys for api lookups, dict is saved as hash and set as set.
+    mom_index is keyed by trans_key(Mom) like the api names, user:<euser> holds the job ids of that user
+    """
+    nodes = data.get('nodes', {})
+    mom_index = {}
+    for node, node_data in nodes.items():
+        if mom := node_data.get('Mom'):
+            mom_index.setdefault(trans_key(mom), []).append(node)
+    user_jobs = {}
+    for job_data in data.get('Jobs', {}).values():
+        if user := job_data.get('euser'):
+            user_jobs.setdefault(f'user:{user}', set()).add(job_data['id'])
+    return {'mom_index': {mom: orjson.dumps(keys) for mom, keys in mom_index.items()},
+            'jobs': set(data.get('Jobs', {})),
+            'nodes': {node.partition('_')[0] for node in nodes},
+            **user_jobs}
+
+
+def dump_fields(data: dict) -> Dict[str, Tuple[bytes, str]]:
+    """
+    serialize every top level field of pbs data, with the digest of its content
+    """
+    result = {}
+    for field, value in data.items():
+        payload = orjson.dumps(value)
+        result[field] = (payload, hashlib.blake2b(payload, digest_size=16).hexdigest())
+    return result
+
+
+def save_data(r: redis.Redis, key: str, fields: Dict[str, Tuple[bytes, str]], indices: dict):
+    """
+    save changed fields of pbs data and its indices in one transaction
+    """
+    digest_key = f'{key}:digest'
+    indices_key = f'{key}:indices'
+    prefetch = r.pipeline(transaction=False)
+    prefetch.exists(key)
+    prefetch.hgetall(digest_key)
+    prefetch.smembers(indices_key)
+    exists, saved, saved_indices = prefetch.execute()
+    saved = {k.decode(): v.decode() for k, v in saved.items()} if exists else {}
+    pipe = r.pipeline()
+    if not exists:
+        pipe.execute_command('JSON.SET', key, '$', b'{}')
+    for field, (payload, digest) in fields.items():
+        if saved.get(field) != digest:
+            pipe.execute_command('JSON.SET', key, f'$.{field}', payload)
+    for field in saved.keys() - fields.keys():
+        pipe.execute_command('JSON.DEL', key, f'$.{field}')
+    pipe.delete(digest_key)
+    pipe.hset(digest_key, mapping={field: digest for field, (_, digest) in fields.items()})
+    for name in {n.decode() for n in saved_indices} - indices.keys():
+        pipe.delete(f'{key}:{name}')
+    for name, value in indices.items():
+        index_key = f'{key}:{name}'
+        pipe.delete(index_key)
+        if not value:
+            continue
+        if isinstance(value, dict):
+            pipe.hset(index_key, mapping=value)
+        else:
+            pipe.sadd(index_key, *value)
+    pipe.delete(indices_key)
+    pipe.sadd(indices_key, *indices)
+    pipe.execute()
+
+
+def push(r: redis.Redis, host: str, key: str, fields: Dict[str, Tuple[bytes, str]], indices: dict):
+    """
+    save pbs data into one redis, errors are logged
+    """
+    logging.info('saving data in %s', host)
+    try:
+        save_data(r, key, fields, indices)
+    except Exception as e:
+        logging.error(f'redis at {host} error: {str(e)}')
+
+
+def sync(location: str, conns: list):
+    """
+    save current pbs data into every redis
+    """
+    data = pbs_data_ex()
+    fields = dump_fields(data)
+    indices = build_indices(data)
+    with ThreadPoolExecutor(max(len(conns), 1)) as executor:
+        for r, host in conns:
+            executor.submit(push, r, host, f'pbs_{location}', fields, indices)
+
+
 if __name__ == '__main__':
     args = parser.parse_args()
     log_level = getattr(logging, args.log_level.upper())
@@ -328,16 +483,24 @@ if __name__ == '__main__':
         logging.error(f"can not load configuration: {str(e)}")
         exit(-1)
     location = config['location']
-    conns = [(redis.ConnectionPool(**conf), host) for host, conf in config['redis'].items()]
-    data = pbs_data_ex()
+    conns = [(redis.Redis(connection_pool=redis.ConnectionPool(**{**pool_options, **conf})), host)
+             for host, conf in config['redis'].items()]
     if args.test:
-        print(json.dumps(data, indent=True))
+        print(json.dumps(pbs_data_ex(), indent=True))
         exit(0)
-    for con, host in conns:
-        logging.info(f'saving data in {host}')
+    if not args.interval:
+        sync(location, conns)
+        exit(0)
+    next_run = time.monotonic()
+    while True:
         try:
-            r = redis.Redis(connection_pool=con, socket_timeout=5, socket_connect_timeout=2)
-            j = r.json()
-            j.set(f'pbs_{location}', '$', data)
+            sync(location, conns)
         except Exception as e:
-            logging.error(f'redis at {host} error: {str(e)}')
+            logging.error(f'sync error: {str(e)}')
+        next_run += args.interval
+        delay = next_run - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            logging.warning('sync took longer than %ss', args.interval)
+            next_run = time.monotonic()